@@ -2,59 +2,156 @@
 # Written by Joshua Jordi
 
 import os
+import shlex
+import subprocess
+import sys
+from pathlib import Path
+
+HOME = os.environ.get('HOME', os.path.expanduser('~'))
+TMP_META = os.path.join(HOME, '.neomutt', 'keybaseMutt', '.tmp')
+HISTORY = os.path.join(HOME, '.neomutt', 'keybaseMutt', '.history')
+HISTORY_LENGTH = 1000
+
+# Options that would make keybase read or write somewhere other than the draft, or print something else
+FORBIDDEN = ('-i', '--infile', '-o', '--outfile', '-h', '--help')
+
+# (st_mtime_ns, contents) of TMP_META when it was last read
+_tmp_cache = (None, None)
 
 def helpfunc():
     print("Run keybase commands here as if you were using keybase. WARNING: this program is not capable of MIME formatting. Only inline.")
-    print("To encrypt, use keybase syntax. (ie. 'keybase encrypt jakkinstewart' or 'keybase pgp encrypt jakkinstewart') Do not include a '-i' or '-o'. This script uses them in the background. Including either flag will mess with the script. (Unless that's what you want to do.)")
+    print("To encrypt, use keybase syntax. (ie. 'keybase encrypt jakkinstewart' or 'keybase pgp encrypt jakkinstewart') Do not include a '-i' or '-o'. This script pipes the message through keybase in the background, so commands using either flag are refused.")
     print("Don't worry about finding or attaching the file, the macro will take care of that.")
     print("To sign, give it the style ('sign' or 'pgp sign'. It will automatically include the signature in the file.")
     print("This program will not be able to decrypt or verify messages. I've created separate scripts for that.")
     print('Type "quit" to quit.')
 
+def readTmp():
+    # The editor macro rewrites .tmp for every new draft; only re-read it when it has changed.
+    global _tmp_cache
+    mtime = os.stat(TMP_META).st_mtime_ns
+    if mtime != _tmp_cache[0]:
+        _tmp_cache = (mtime, Path(TMP_META).read_text().rstrip('\n'))
+    return _tmp_cache[1]
+
 def encryptSign(parameters):
-    os.system('echo $HOME > .file')
-    directory = open('.file', 'r')
-    pwd = directory.read().strip('\n')
-    directory.close()
-    tmp = open("%s/.neomutt/keybaseMutt/.tmp" % pwd, "r")
-    tmp = tmp.read().strip("\n")
+    try:
+        tmp = readTmp()
+    except OSError as e:
+        print("Could not read %s: %s" % (TMP_META, e.strerror))
+        return
     print("Working....")
-    os.system('%s -i %s -o %s' % (parameters, tmp, tmp))
+    try:
+        argv = shlex.split(parameters)
+    except ValueError as e:
+        print("Could not parse the command: %s" % e)
+        return
+    for arg in argv:
+        if arg.split('=', 1)[0] in FORBIDDEN:
+            print("%s is not allowed here, the message was left untouched." % arg)
+            return
+    try:
+        message = open(tmp, 'rb')
+    except OSError as e:
+        print("Could not read %s: %s" % (tmp, e.strerror))
+        return
+    with message:
+        try:
+            result = subprocess.run(argv, stdin=message, stdout=subprocess.PIPE)
+        except OSError as e:
+            print("Could not run %s: %s" % (argv[0], e.strerror))
+            return
+    if result.returncode != 0:
+        print("keybase failed, the message was left untouched.")
+        return
+    if not result.stdout:
+        print("keybase printed nothing, the message was left untouched.")
+        return
+    try:
+        with open(tmp, 'wb') as message:
+            message.write(result.stdout)
+    except OSError as e:
+        print("Could not write %s: %s" % (tmp, e.strerror))
+        return
     print("Done!")
 
-#def sign(parameters):
-#    os.system('pwd > .file')
-#    directory = open('.file', 'r')
-#    pwd = directory.read().strip('\n')
-#    directory.close()
-#    tmp = open('%s/.neomutt/keybaseMutt/.tmp' % pwd, 'r')
-#    tmp = tmp.read().strip('\n')
-#    print("Working...")
-#    os.system('%s -i %s -o %s' % (parameters, tmp, tmp))
-#    print("Done!")
+# Words that may precede the actual command, as in 'keybase pgp encrypt'.
+# Options such as '--debug' may also come before it and are skipped too.
+PREFIXES = ('keybase', 'pgp')
+
+DISPATCH = {
+    'help': lambda parameters: helpfunc(),
+    'encrypt': encryptSign,
+    'sign': encryptSign,
+}
+
+def commandName(parameters):
+    for word in parameters.split():
+        word = word.lower()
+        if word not in PREFIXES and not word.startswith('-'):
+            return word
+    return ''
+
+COMMANDS = PREFIXES + tuple(DISPATCH) + ('quit', 'exit')
+
+def complete(text, state):
+    matches = [c for c in COMMANDS if c.startswith(text)]
+    return matches[state] if state < len(matches) else None
+
+def readPrompt():
+    try:
+        return input('neomutt#: ')
+    except EOFError:
+        return None
 
-exitVar = ''
+def readPiped():
+    line = sys.stdin.readline()
+    return line.rstrip('\n') if line else None
 
-print("Type help to learn how to use me.")
+def repl(readLine):
+    while True:
+        inputStuffs = readLine()
+        if inputStuffs is None:
+            break
+        cmd = commandName(inputStuffs)
+        handler = DISPATCH.get(cmd)
+        if handler:
+            handler(inputStuffs)
 
-while exitVar.lower() != 'quit':
-    inputStuffs = input('neomutt#: ')
-    if (inputStuffs.lower() == 'help'):
-        helpfunc()
+        elif cmd in ('quit', 'exit'):
+            break
 
-    elif ('encrypt' in inputStuffs):
-        encryptSign(inputStuffs)
+        else:
+            print("You didn't use a known keybase command.")
 
-    #elif ('decrypt' in inputStuffs):
-    #    decrypt(inputStuffs)
+def main():
+    print("Type help to learn how to use me.")
 
-    elif ('sign' in inputStuffs):
-        encryptSign(inputStuffs)
+    # Commands piped in from a script need neither a prompt nor line editing.
+    if not sys.stdin.isatty():
+        repl(readPiped)
+        return
 
-    elif ('quit' in inputStuffs or 'exit' in inputStuffs):
-        exitVar = 'quit'
+    try:
+        import readline
+    except ImportError:
+        repl(readPrompt)
+        return
 
-    else:
-        print("You didn't use a known keybase command.")
+    readline.set_completer(complete)
+    readline.parse_and_bind('tab: complete')
+    readline.set_history_length(HISTORY_LENGTH)
+    try:
+        readline.read_history_file(HISTORY)
+    except OSError:
+        pass
+    try:
+        repl(readPrompt)
+    finally:
+        try:
+            readline.write_history_file(HISTORY)
+        except OSError:
+            pass
 
-os.system('rm .file')
+if __name__ == '__main__':
+    main()